@@ -615,6 +615,8 @@ async function to_jira(wb: ExcelScript.Workbook, cfg: Config) {
     let res: Object = await sendPostRequest(cfg.JIRA_PROXY + '/update_issues', data) as Object;
     if ('error' in res)
         result(false, wb, cfg, res["error"])
+    else if ('batch_id' in res)
+        result(true, wb, cfg, `Queued: ${res["queued_keys"]}`);
     else
         result(true, wb, cfg, `Updated: ${res["updated_keys"]}`);
 }
@@ -1,14 +1,21 @@
 import unittest
 import json
 import asyncio
+import gzip
 import logging
+import os
+import tempfile
+import time
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from threading import Thread
+from types import SimpleNamespace
 from urllib.parse import urlparse
-from aiohttp import ClientSession
-from twinpigs_jira_driver import RequestHandler, run
+from aiohttp import ClientSession, ClientTimeout
+from twinpigs_jira_driver import RequestHandler, run, JiraTransport, RecordingTransport, ReplayTransport, WriteBehindQueue
 
 class FakeJiraHandler(BaseHTTPRequestHandler):
+    updates = []
+
     def do_GET(self):
         parsed_path = urlparse(self.path)
         if parsed_path.path == '/rest/api/2/search':
@@ -29,7 +36,7 @@ class FakeJiraHandler(BaseHTTPRequestHandler):
         self.send_response(200)
         self.send_header('Content-Type', 'application/json')
         self.end_headers()
-        response = {'issues': [{'key': 'TEST-1', 'fields': {'assignee': {'displayName': 'Twin Pigs'}, 'resolution': {}, 'summary': 'A[5A+3B](2A+1B) Some description'}}]}
+        response = {'issues': [{'key': 'TEST-1', 'self': 'http://localhost:8081/rest/api/2/issue/10001', 'fields': {'assignee': {'displayName': 'Twin Pigs', 'emailAddress': 'pigs@example.com'}, 'resolution': {}, 'summary': 'A[5A+3B](2A+1B) Some description'}}]}
         self.wfile.write(json.dumps(response).encode('utf-8'))
 
     def handle_update(self, key):
@@ -37,6 +44,7 @@ class FakeJiraHandler(BaseHTTPRequestHandler):
         post_data = self.rfile.read(content_length)
         data = json.loads(post_data)
         summary = data['fields']['summary']
+        FakeJiraHandler.updates.append((key, summary))
         self.send_response(204)
         self.end_headers()
         logging.info(f"Updated issue {key} with summary: {summary}")
@@ -103,6 +111,301 @@ class TestRequestHandler(unittest.TestCase):
 
         asyncio.run(test())
 
+    def test_record_and_replay(self):
+        async def test():
+            headers = {'Authorization': 'Bearer secret_token'}
+            search_url = 'http://localhost:8081/rest/api/2/search?jql=project%3DTEST'
+            update_url = 'http://localhost:8081/rest/api/2/issue/TEST-1'
+            recorder = RecordingTransport(JiraTransport(), cassette)
+            recorded_search = await recorder.request('GET', search_url, headers)
+            recorded_update = await recorder.request('PUT', update_url, headers, {'fields': {'summary': 'X'}})
+
+            with gzip.open(cassette, 'rb') as f:
+                raw = f.read()
+            self.assertNotIn(b'secret_token', raw)
+            self.assertNotIn(b'localhost:8081', raw)
+            self.assertNotIn(b'pigs@example.com', raw)
+            self.assertNotIn(b'Twin Pigs', raw)
+            self.assertNotIn(b'project', raw)
+
+            # The host is not recorded, so the cassette replays against any Jira URL
+            replayer = ReplayTransport(cassette, speed=0)
+            status, body = await replayer.request('GET', 'http://jira.invalid/rest/api/2/search?jql=project%3DTEST', {})
+            self.assertEqual(status, 200)
+            assignee = body['issues'][0]['fields']['assignee']['displayName']
+            self.assertEqual(body, {'issues': [{'key': 'TEST-1', 'fields': {'summary': 'A[5A+3B](2A+1B) Some description', 'resolution': {}, 'assignee': {'displayName': assignee}}}]})
+            # The same name always gets the same placeholder
+            self.assertTrue(assignee.startswith('user-'))
+            self.assertEqual((await replayer.request('GET', search_url, {}))[1]['issues'][0]['fields']['assignee']['displayName'], assignee)
+            self.assertEqual(await replayer.request('PUT', update_url, {}, {'fields': {'summary': 'X'}}), recorded_update)
+            self.assertEqual(recorded_search[0], 200)
+            self.assertEqual(recorded_search[1]['issues'][0]['key'], 'TEST-1')
+            self.assertEqual(recorded_update, (204, None))
+            with self.assertRaises(Exception):
+                await replayer.request('PUT', update_url, {}, {'fields': {'summary': 'Y'}})
+
+            # Failed requests are recorded too and fail again on replay
+            unreachable_url = 'http://localhost:8099/rest/api/2/issue/TEST-1'
+            with self.assertRaises(Exception) as recorded_error:
+                await recorder.request('PUT', unreachable_url, headers, {'fields': {'summary': 'Z'}})
+            with self.assertRaises(Exception) as replayed_error:
+                await ReplayTransport(cassette, speed=0).request('PUT', unreachable_url, {}, {'fields': {'summary': 'Z'}})
+            self.assertEqual(str(replayed_error.exception), str(recorded_error.exception).replace('localhost', 'jira.invalid'))
+            self.assertNotIn('No recorded exchange', str(replayed_error.exception))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cassette = os.path.join(tmp, 'jira.jsonl.gz')
+            asyncio.run(test())
+
+    def test_replay_timings(self):
+        async def replay_time(replayer, timeout=None):
+            started = time.monotonic()
+            await replayer.request('PUT', 'http://jira.invalid/rest/api/2/issue/TEST-1', {}, {'fields': {'summary': 'X'}}, timeout)
+            return time.monotonic() - started
+
+        async def test():
+            self.assertGreaterEqual(await replay_time(ReplayTransport(cassette)), 0.4)
+            self.assertTrue(0.2 <= await replay_time(ReplayTransport(cassette, speed=2)) < 0.4)
+            with self.assertRaisesRegex(Exception, 'deadline'):
+                await replay_time(ReplayTransport(cassette), timeout=0.1)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cassette = os.path.join(tmp, 'jira.jsonl.gz')
+            with gzip.open(cassette, 'wt', encoding='utf-8') as f:
+                f.write(json.dumps({'method': 'PUT', 'url': '/rest/api/2/issue/TEST-1', 'data': {'fields': {'summary': 'X'}},
+                                    'status': 204, 'body': None, 'elapsed': 0.4}) + '\n')
+            asyncio.run(test())
+
+
+class TestWriteBehind(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.jira_server = HTTPServer(('localhost', 8083), FakeJiraHandler)
+        cls.jira_thread = Thread(target=cls.jira_server.serve_forever)
+        cls.jira_thread.start()
+
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.proxy_server = HTTPServer(('localhost', 8082), RequestHandler)
+        cls.proxy_server.token = 'test_token'
+        cls.proxy_server.jira_server = 'http://localhost:8083'
+        cls.proxy_server.write_behind = WriteBehindQueue(cls.proxy_server, os.path.join(cls.tmp.name, 'journal.jsonl'))
+        cls.proxy_server.write_behind.start()
+        cls.proxy_thread = Thread(target=cls.proxy_server.serve_forever)
+        cls.proxy_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.proxy_server.shutdown()
+        cls.proxy_thread.join()
+        cls.jira_server.shutdown()
+        cls.jira_thread.join()
+        cls.tmp.cleanup()
+
+    async def send_request(self, url, data):
+        async with ClientSession() as session:
+            async with session.post(url, json=data) as response:
+                return await response.json()
+
+    def test_update_issues_write_behind(self):
+        async def test():
+            response = await self.send_request('http://localhost:8082/update_issues', {
+                'issues': [{'key': 'TEST-2', 'summary': 'Queued', 'estimates': {'A': 1}, 'remaining_estimates': {'A': 1}}],
+                'jql': 'project=TEST',
+                'resource_groups': ['A', 'B'],
+                'version': 5,
+            })
+            self.assertEqual(response['queued_keys'], ['TEST-2'])
+            self.assertNotIn('updated_keys', response)
+            for _ in range(50):
+                status = await self.send_request('http://localhost:8082/update_status', {'batch_id': response['batch_id']})
+                if status['done']:
+                    break
+                await asyncio.sleep(0.1)
+            self.assertEqual(status, {'pending': [], 'updated': ['TEST-2'], 'superseded': [], 'failed': [], 'done': True})
+            status = await self.send_request('http://localhost:8082/update_status', {'batch_id': 'wrong'})
+            self.assertIn('Unknown batch_id', status['error'])
+            self.assertIn(('TEST-2', '[1A]Queued'), FakeJiraHandler.updates)
+
+        asyncio.run(test())
+
+    def test_journal_survives_restart(self):
+        journal = os.path.join(self.tmp.name, 'restart.jsonl')
+        queue = WriteBehindQueue(self.proxy_server, journal)
+        first = queue.enqueue({'TEST-3': 'old', 'TEST-4': 'kept'})
+        second = queue.enqueue({'TEST-3': 'new'})
+        self.assertEqual(queue.status(first)['superseded'], ['TEST-3'])
+
+        # The queue was never started, so nothing was sent and everything is still in the journal
+        restarted = WriteBehindQueue(self.proxy_server, journal)
+        self.assertEqual(restarted.queued_summaries(), {'TEST-3': 'new', 'TEST-4': 'kept'})
+        self.assertEqual(restarted.status(second)['pending'], ['TEST-3'])
+
+        asyncio.run(restarted.flush(list(restarted.pending.values())))
+        self.assertEqual(restarted.queued_summaries(), {})
+        self.assertEqual(restarted.status(), {'pending': [], 'updated': [], 'superseded': [], 'failed': [], 'done': True})
+        # The superseded update of TEST-3 is not reloaded, so the first batch only has TEST-4 after the restart
+        self.assertEqual(restarted.status(first), {'pending': [], 'updated': ['TEST-4'], 'superseded': [], 'failed': [], 'done': True})
+        self.assertTrue(restarted.status(restarted.enqueue({}))['done'])
+        self.assertEqual(WriteBehindQueue(self.proxy_server, journal).queued_summaries(), {})
+
+    def test_failed_updates_are_retried(self):
+        class UnavailableJiraTransport:
+            async def request(self, method, url, headers, data=None, timeout=None):
+                return 503, 'Service Unavailable'
+
+        class AvailableJiraTransport:
+            async def request(self, method, url, headers, data=None, timeout=None):
+                return 204, None
+
+        server = SimpleNamespace(jira_server='http://jira.invalid', token='test_token', transport=UnavailableJiraTransport())
+        journal = os.path.join(self.tmp.name, 'retry.jsonl')
+        queue = WriteBehindQueue(server, journal)
+        batch_id = queue.enqueue({'TEST-5': 'retried'})
+        asyncio.run(queue.flush(queue.ready_records()))
+
+        status = queue.status(batch_id)
+        self.assertEqual(status['failed'], [{'key': 'TEST-5', 'error': 'Jira PUT status 503', 'attempts': 1, 'retrying': True}])
+        self.assertFalse(status['done'])
+        # The failed update waits for a retry and is still in the journal
+        self.assertEqual(queue.ready_records(), [])
+        self.assertEqual(WriteBehindQueue(server, journal).queued_summaries(), {'TEST-5': 'retried'})
+
+        server.transport = AvailableJiraTransport()
+        queue.failures['TEST-5']['retry_at'] = 0
+        asyncio.run(queue.flush(queue.ready_records()))
+        self.assertEqual(queue.queued_summaries(), {})
+        self.assertEqual(queue.status(batch_id)['updated'], ['TEST-5'])
+        self.assertEqual(WriteBehindQueue(server, journal).queued_summaries(), {})
+
+    def test_rejected_updates_are_not_retried(self):
+        class MissingIssueJiraTransport:
+            async def request(self, method, url, headers, data=None, timeout=None):
+                return 404, {'errorMessages': ['Issue does not exist']}
+
+        server = SimpleNamespace(jira_server='http://jira.invalid', token='test_token', transport=MissingIssueJiraTransport())
+        journal = os.path.join(self.tmp.name, 'rejected.jsonl')
+        queue = WriteBehindQueue(server, journal)
+        batch_id = queue.enqueue({'TEST-6': 'deleted'})
+        asyncio.run(queue.flush(queue.ready_records()))
+
+        self.assertEqual(queue.status(batch_id), {'pending': [], 'updated': [], 'superseded': [], 'failed': [
+            {'key': 'TEST-6', 'error': 'Jira PUT status 404', 'attempts': 1, 'retrying': False}
+        ], 'done': True})
+        self.assertEqual(queue.queued_summaries(), {})
+        # The journal is compacted as nothing is pending
+        with open(journal, encoding='utf-8') as f:
+            self.assertEqual(f.read(), '')
+
+    def test_flusher_survives_errors(self):
+        class AvailableJiraTransport:
+            async def request(self, method, url, headers, data=None, timeout=None):
+                return 204, None
+
+        server = SimpleNamespace(jira_server='http://jira.invalid', token='test_token', transport=AvailableJiraTransport())
+        queue = WriteBehindQueue(server, os.path.join(self.tmp.name, 'errors.jsonl'))
+        queue.retry_delay = 0.01
+        flush = queue.flush
+        calls = []
+
+        async def failing_flush(records):
+            calls.append(records)
+            if len(calls) == 1:
+                raise OSError('No space left on device')
+            await flush(records)
+
+        queue.flush = failing_flush
+        queue.start()
+        batch_id = queue.enqueue({'TEST-7': 'flushed'})
+        for _ in range(50):
+            if queue.status(batch_id)['done']:
+                break
+            time.sleep(0.1)
+        self.assertEqual(queue.status(batch_id)['updated'], ['TEST-7'])
+        self.assertEqual(len(calls), 2)
+
+
+class SlowJiraTransport:
+    # Finds no issues and updates TEST-1 at once, while other updates take too long
+    def __init__(self):
+        self.cancelled = []
+
+    async def request(self, method, url, headers, data=None, timeout=None):
+        if method == 'GET':
+            return 200, {'issues': []}
+        key = url.split('/')[-1]
+        if key != 'TEST-1':
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                self.cancelled.append(key)
+                raise
+        return 204, None
+
+
+class TestDeadlines(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.proxy_server = HTTPServer(('localhost', 8084), RequestHandler)
+        cls.proxy_server.token = 'test_token'
+        cls.proxy_server.jira_server = 'http://localhost:8085'
+        cls.proxy_server.request_timeout = 10
+        cls.proxy_thread = Thread(target=cls.proxy_server.serve_forever)
+        cls.proxy_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.proxy_server.shutdown()
+        cls.proxy_thread.join()
+
+    def setUp(self):
+        self.proxy_server.transport = SlowJiraTransport()
+        self.data = {
+            'issues': [{'key': 'TEST-1', 'summary': 'Fast'}, {'key': 'TEST-2', 'summary': 'Slow'}],
+            'jql': 'project=TEST',
+            'resource_groups': ['A'],
+            'version': 5,
+        }
+
+    def test_deadline_reports_partial_results(self):
+        async def test():
+            async with ClientSession() as session:
+                async with session.post('http://localhost:8084/update_issues', json=self.data, headers={'X-Request-Timeout': '0.5'}) as response:
+                    return await response.json()
+
+        started = time.monotonic()
+        response = asyncio.run(test())
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertIn('error', response)
+        self.assertEqual(response['updated_keys'], ['TEST-1'])
+        self.assertEqual(response['not_updated_keys'], ['TEST-2'])
+        self.assertEqual(self.proxy_server.transport.cancelled, ['TEST-2'])
+
+    def test_invalid_request_timeout(self):
+        async def test(timeout):
+            async with ClientSession() as session:
+                async with session.post('http://localhost:8084/update_issues', json=self.data, headers={'X-Request-Timeout': timeout}) as response:
+                    return response.status, await response.json()
+
+        for timeout in ['0', '-1', 'inf', '1e400', 'nan', 'soon']:
+            status, response = asyncio.run(test(timeout))
+            self.assertEqual(status, 400)
+            self.assertIn('Invalid X-Request-Timeout', response['error'])
+        self.assertEqual(self.proxy_server.transport.cancelled, [])
+
+    def test_client_disconnect_cancels_jira_calls(self):
+        async def test():
+            async with ClientSession(timeout=ClientTimeout(total=0.5)) as session:
+                with self.assertRaises(asyncio.TimeoutError):
+                    async with session.post('http://localhost:8084/update_issues', json=self.data) as response:
+                        await response.json()
+
+        asyncio.run(test())
+        for _ in range(50):
+            if self.proxy_server.transport.cancelled:
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.proxy_server.transport.cancelled, ['TEST-2'])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -4,8 +4,18 @@ import argparse
 import sys
 import re
 import logging
+import gzip
+import time
+import threading
+import os
+import uuid
+import hashlib
+import math
+import select
+import socket
+from collections import OrderedDict, defaultdict, deque
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import urlparse, parse_qs, urlencode
+from urllib.parse import urlparse, parse_qs, parse_qsl, urlencode
 import aiohttp
 from base64 import b64encode
 
@@ -13,7 +23,8 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 
 
 SCRIPT_VERSION = 5
-DRIVER_VERSION = '5.1'
+DRIVER_VERSION = '5.2'
+DEFAULT_REQUEST_TIMEOUT = 120
 
 
 ################################# THE PARSER/ENCODER GENERATED BLOCK #################################
@@ -209,6 +220,404 @@ def encode_summary(group_names, summary_dict):
 ################################# THE END OF THE GENERATED BLOCK #################################
 
 
+class JiraTransport:
+    """
+    Sends a single request to Jira and returns a (status, body) tuple.
+
+    The body is the decoded JSON response, the response text if it is not JSON, or None if it is empty.
+    The request fails if it does not finish in timeout seconds (None means no limit).
+    This is the live implementation; the recording and replaying transports below share its interface.
+    """
+    async def request(self, method, url, headers, data=None, timeout=None):
+        if timeout is not None and timeout <= 0:
+            raise deadline_error(method)
+        # Without a deadline, the aiohttp default limits apply
+        session_args = {'timeout': aiohttp.ClientTimeout(total=timeout)} if timeout is not None else {}
+        try:
+            async with aiohttp.ClientSession(**session_args) as session:
+                async with session.request(method, url, json=data, headers=headers) as resp:
+                    return resp.status, decode_body(await resp.read())
+        except asyncio.TimeoutError:
+            raise deadline_error(method)
+
+
+def deadline_error(method):
+    return Exception(f"Jira {method} request was not finished before the deadline")
+
+
+def decode_body(raw):
+    if not raw:
+        return None
+    text = raw.decode('utf-8', errors='replace')
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def placeholder(prefix, value):
+    # The same value always gets the same placeholder, so redacted cassettes still match and group correctly
+    return f'{prefix}-{hashlib.sha256(value.encode("utf-8")).hexdigest()[:12]}'
+
+
+def redact_url(url):
+    # Cassettes keep only the path and the query with the JQL replaced by a placeholder, so they never
+    # contain the Jira host or the query text and may be replayed against whatever --jira value is passed later.
+    parsed = urlparse(url)
+    if not parsed.query:
+        return parsed.path
+    query = [(name, placeholder('jql', value) if name == 'jql' else value) for name, value in parse_qsl(parsed.query)]
+    return f'{parsed.path}?{urlencode(query)}'
+
+
+def redact_text(text, url):
+    host = urlparse(url).hostname
+    return text.replace(host, 'jira.invalid') if host else text
+
+
+PERSONAL_FIELDS = {'self', 'emailAddress', 'avatarUrls', 'accountId', 'name', 'key'}
+
+
+def redact_body(body, url):
+    """
+    Returns a copy of a Jira response body which may be saved to a cassette.
+
+    Search results are reduced to the fields the driver reads, with the assignee names replaced by
+    placeholders. Anything else loses the fields holding URLs or personal data, and the Jira host
+    is removed from the remaining strings.
+    """
+    if isinstance(body, dict) and isinstance(body.get('issues'), list):
+        issues = []
+        for issue in body['issues']:
+            fields = issue.get('fields', {})
+            assignee = fields.get('assignee')
+            issues.append({
+                'key': issue.get('key'),
+                'fields': {
+                    'summary': fields.get('summary'),
+                    # Only the presence of a resolution is used
+                    'resolution': {} if fields.get('resolution') is not None else None,
+                    'assignee': {'displayName': redact_name(assignee.get('displayName', ''))} if assignee else None,
+                },
+            })
+        return {'issues': issues}
+
+    def redact(value):
+        if isinstance(value, dict):
+            return {k: redact(v) for k, v in value.items() if k not in PERSONAL_FIELDS}
+        if isinstance(value, list):
+            return [redact(v) for v in value]
+        if isinstance(value, str):
+            return redact_text(value, url)
+        return value
+
+    return redact(body)
+
+
+def redact_name(name):
+    # process_jira_response shortens the external users' marker, so keep it
+    return placeholder('user', name) + (' (External)' if '(External)' in name else '') if name else name
+
+
+def exchange_key(method, redacted_url, data):
+    return method, redacted_url, json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+
+class RecordingTransport:
+    """
+    Forwards requests to another transport and appends every exchange to a gzipped JSON lines cassette.
+
+    Request headers (and therefore credentials) are never written, the JQL and the assignee names are
+    replaced by placeholders, and other URLs and personal fields are dropped (see redact_url and redact_body).
+    The issue keys, summaries and resolution flags are written as they are.
+    Failed requests are recorded with their error message and replayed as failures.
+    """
+    def __init__(self, transport, cassette):
+        self.transport = transport
+        self.cassette = cassette
+        self.lock = threading.Lock()
+
+    async def request(self, method, url, headers, data=None, timeout=None):
+        started = time.monotonic()
+        exchange = {'method': method, 'url': redact_url(url), 'data': data}
+        try:
+            status, body = await self.transport.request(method, url, headers, data, timeout)
+        except Exception as e:
+            exchange.update({'error': redact_text(str(e), url), 'elapsed': round(time.monotonic() - started, 3)})
+            self.write(exchange)
+            logging.info(f"Recorded {method} {exchange['url']}: failed in {exchange['elapsed']}s")
+            raise
+        exchange.update({'status': status, 'body': redact_body(body, url), 'elapsed': round(time.monotonic() - started, 3)})
+        self.write(exchange)
+        logging.info(f"Recorded {method} {exchange['url']}: {status} in {exchange['elapsed']}s")
+        return status, body
+
+    def write(self, exchange):
+        with self.lock:
+            # Every write is a separate gzip member, so the cassette stays readable if the driver is killed
+            with gzip.open(self.cassette, 'at', encoding='utf-8') as f:
+                f.write(json.dumps(exchange, separators=(',', ':')) + '\n')
+
+
+class ReplayTransport:
+    """
+    Serves the exchanges stored by RecordingTransport without touching the network.
+
+    Identical requests get their recorded responses in the original order, the last one is repeated
+    when they run out. speed=1 keeps the recorded timings, speed=2 halves them, speed=0 disables delays.
+    Recorded failures are raised again after their recorded delay.
+    """
+    def __init__(self, cassette, speed=1.0):
+        self.speed = speed
+        self.exchanges = defaultdict(deque)
+        with gzip.open(cassette, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    exchange = json.loads(line)
+                    key = exchange_key(exchange['method'], exchange['url'], exchange['data'])
+                    self.exchanges[key].append(exchange)
+        self.lock = threading.Lock()
+        logging.info(f"Loaded {sum(len(q) for q in self.exchanges.values())} exchanges from {cassette}")
+
+    async def request(self, method, url, headers, data=None, timeout=None):
+        key = exchange_key(method, redact_url(url), data)
+        with self.lock:
+            queue = self.exchanges.get(key)
+            if not queue:
+                raise Exception(f"No recorded exchange for {method} {redact_url(url)}")
+            exchange = queue.popleft() if len(queue) > 1 else queue[0]
+        delay = exchange['elapsed'] / self.speed if self.speed > 0 else 0
+        if timeout is not None and delay > timeout:
+            await asyncio.sleep(max(timeout, 0))
+            raise deadline_error(method)
+        await asyncio.sleep(delay)
+        if 'error' in exchange:
+            raise Exception(exchange['error'])
+        return exchange['status'], exchange['body']
+
+
+def jira_headers(server):
+    return {
+        'Authorization': f'Bearer {server.token}' if server.token else ('Basic ' + b64encode(f"{server.user}:{server.password}".encode()).decode()),
+        'Content-Type': 'application/json'
+    }
+
+
+class WriteBehindQueue:
+    """
+    Keeps summary updates in a local JSON lines journal and sends them to Jira in a background thread.
+
+    The journal contains {"seq", "batch", "key", "summary"} records for queued updates and {"done": seq}
+    records for the finished ones, so updates that were not sent before a crash are sent after a restart.
+    Failed updates stay in the journal and are retried with an exponential backoff, except for the
+    updates rejected by Jira with a 4xx status other than 401, 403, 408 and 429: they fail for good.
+    Only the latest summary is sent when a key is updated again before the previous update was sent.
+    The results of the last finished_batches finished batches are kept in memory until a restart.
+    """
+    put_timeout = 60
+    retry_delay = 1
+    max_retry_delay = 300
+    finished_batches = 100
+    # Client errors which may go away without changing the update (expired token, rate limits)
+    retried_statuses = {401, 403, 408, 429}
+
+    def __init__(self, server, journal, concurrency=4):
+        self.server = server
+        self.journal = journal
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.pending = {}   # key -> the latest queued record
+        self.failures = {}  # key -> {'error', 'attempts', 'retry_at'} for the queued record which failed
+        # batch id -> {key: 'pending' | 'updated' | 'superseded' | {'error', 'attempts'} for a final failure}
+        self.batches = {}
+        self.finished = OrderedDict()  # the same for the last finished batches
+        self.journal_lines = 0
+        self.seq = 0
+        self.load()
+
+    def load(self):
+        latest = {}
+        done = set()
+        if os.path.exists(self.journal):
+            with open(self.journal, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last line may be cut off if the driver was killed while writing it
+                        continue
+                    if 'done' in record:
+                        done.add(record['done'])
+                    else:
+                        latest[record['key']] = record
+                        self.seq = max(self.seq, record['seq'])
+        self.pending = {key: record for key, record in latest.items() if record['seq'] not in done}
+        for record in self.pending.values():
+            self.batches.setdefault(record['batch'], {})[record['key']] = 'pending'
+        # Compact the journal to the updates that still have to be sent
+        self.rewrite_journal()
+        if self.pending:
+            logging.info(f"Loaded {len(self.pending)} pending updates from {self.journal}")
+
+    def rewrite_journal(self):
+        tmp = self.journal + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for record in self.pending.values():
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.journal)
+        self.journal_lines = len(self.pending)
+
+    def append(self, records):
+        with open(self.journal, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(record) + '\n' for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_lines += len(records)
+
+    def finish_batches(self, batch_ids):
+        for batch_id in batch_ids:
+            if batch_id in self.batches and 'pending' not in self.batches[batch_id].values():
+                self.finished[batch_id] = self.batches.pop(batch_id)
+        while len(self.finished) > self.finished_batches:
+            self.finished.popitem(last=False)
+
+    def queued_summaries(self):
+        with self.lock:
+            return {key: record['summary'] for key, record in self.pending.items()}
+
+    def enqueue(self, summaries):
+        batch_id = uuid.uuid4().hex
+        with self.lock:
+            records = []
+            for key, summary in summaries.items():
+                self.seq += 1
+                records.append({'seq': self.seq, 'batch': batch_id, 'key': key, 'summary': summary})
+            self.append(records)
+            superseded = set()
+            for record in records:
+                previous = self.pending.get(record['key'])
+                if previous:
+                    self.batches[previous['batch']][record['key']] = 'superseded'
+                    superseded.add(previous['batch'])
+                self.pending[record['key']] = record
+                # A new summary is sent at once even if the previous one is waiting for a retry
+                self.failures.pop(record['key'], None)
+            self.batches[batch_id] = {key: 'pending' for key in summaries}
+            self.finish_batches(superseded | {batch_id})
+            self.wakeup.notify()
+        logging.info(f"Queued batch {batch_id}: {list(summaries)}")
+        return batch_id
+
+    def status(self, batch_id=None):
+        """
+        Reports the keys of a batch (or of all the queued batches if batch_id is None) by their state.
+
+        Failed keys are listed with 'retrying' set if they are going to be sent again.
+        """
+        with self.lock:
+            if batch_id is None:
+                states = {}
+                for batch in self.batches.values():
+                    states.update(batch)
+            elif batch_id in self.batches:
+                states = self.batches[batch_id]
+            elif batch_id in self.finished:
+                states = self.finished[batch_id]
+            else:
+                raise Exception(f'Unknown batch_id {batch_id}')
+            result = {'pending': [], 'updated': [], 'superseded': [], 'failed': []}
+            for key, state in states.items():
+                if state == 'pending' and key in self.failures:
+                    failure = self.failures[key]
+                    result['failed'].append({'key': key, 'error': failure['error'], 'attempts': failure['attempts'], 'retrying': True})
+                elif isinstance(state, dict):
+                    result['failed'].append({'key': key, 'error': state['error'], 'attempts': state['attempts'], 'retrying': False})
+                else:
+                    result[state].append(key)
+            result['done'] = not result['pending'] and not any(failure['retrying'] for failure in result['failed'])
+            return result
+
+    def start(self):
+        thread = threading.Thread(target=self.flush_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def ready_records(self):
+        now = time.monotonic()
+        return [record for key, record in self.pending.items()
+                if key not in self.failures or self.failures[key]['retry_at'] <= now]
+
+    def flush_forever(self):
+        errors = 0
+        while True:
+            with self.lock:
+                records = self.ready_records()
+                while not records:
+                    retry_at = [failure['retry_at'] for failure in self.failures.values()]
+                    self.wakeup.wait(max(min(retry_at) - time.monotonic(), 0) if retry_at else None)
+                    records = self.ready_records()
+            try:
+                asyncio.run(self.flush(records))
+                errors = 0
+            except Exception as e:
+                # E.g. the journal cannot be written: keep the updates queued and try again later
+                delay = min(self.retry_delay * 2 ** errors, self.max_retry_delay)
+                errors += 1
+                logging.error(f"Failed to flush queued updates: {e}, retrying in {delay}s")
+                time.sleep(delay)
+
+    async def flush(self, records):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send(record):
+            # Returns None if the update is sent, or the error and whether it is final
+            async with semaphore:
+                jira_url = f'{self.server.jira_server}/rest/api/2/issue/{record["key"]}'
+                data = {'fields': {'summary': record['summary']}}
+                try:
+                    transport = getattr(self.server, 'transport', None) or JiraTransport()
+                    status, _ = await transport.request('PUT', jira_url, jira_headers(self.server), data, self.put_timeout)
+                except Exception as e:
+                    return str(e), False
+                if status == 204:
+                    return None
+                return f'Jira PUT status {status}', 400 <= status < 500 and status not in self.retried_statuses
+
+        results = await asyncio.gather(*(send(record) for record in records))
+        with self.lock:
+            finished = [record for record, result in zip(records, results) if result is None or result[1]]
+            if finished:
+                self.append([{'done': record['seq']} for record in finished])
+            for record, result in zip(records, results):
+                key = record['key']
+                batch = self.batches.get(record['batch'], {})
+                current = self.pending.get(key) is record
+                if result is None:
+                    if batch.get(key) == 'pending':
+                        batch[key] = 'updated'
+                    if current:
+                        del self.pending[key]
+                        self.failures.pop(key, None)
+                elif current:
+                    error, final = result
+                    attempts = self.failures.get(key, {}).get('attempts', 0) + 1
+                    if final:
+                        batch[key] = {'error': error, 'attempts': attempts}
+                        del self.pending[key]
+                        self.failures.pop(key, None)
+                        logging.error(f"Failed to update summary for {key}: {error}, giving up")
+                    else:
+                        delay = min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+                        self.failures[key] = {'error': error, 'attempts': attempts, 'retry_at': time.monotonic() + delay}
+                        logging.error(f"Failed to update summary for {key}: {error}, retrying in {delay}s")
+            self.finish_batches({record['batch'] for record in records})
+            # Compact the journal when it is mostly made of finished updates
+            if not self.pending or self.journal_lines > 2 * len(self.pending) + 100:
+                self.rewrite_journal()
+        logging.info(f"Flushed {len(records)} queued updates, {len(self.pending)} are pending")
 
 
 class RequestHandler(BaseHTTPRequestHandler):
@@ -216,7 +625,7 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, X-Request-Timeout')
         self.end_headers()
 
     def do_POST(self):
@@ -227,14 +636,83 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         logging.info(f"Received POST request on {parsed_path.path} with data: {data}")
 
+        # Everything done for the request so far, reported if it is cancelled
+        self.progress = {}
+        try:
+            self.request_timeout = self.get_request_timeout()
+        except ValueError:
+            self.send_response(400)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(json.dumps({'error': f"Invalid X-Request-Timeout header: {self.headers['X-Request-Timeout']}"}).encode('utf-8'))
+            return
+        self.deadline = time.monotonic() + self.request_timeout
+
         if parsed_path.path == '/query_issues':
-            asyncio.run(self.handle_query_issues(data))
+            asyncio.run(self.run_until_deadline(self.handle_query_issues(data)))
         elif parsed_path.path == '/update_issues':
-            asyncio.run(self.handle_update_issues(data))
+            asyncio.run(self.run_until_deadline(self.handle_update_issues(data)))
+        elif parsed_path.path == '/update_status':
+            self.handle_update_status(data)
         else:
             self.send_response(404)
             self.end_headers()
 
+    def get_request_timeout(self):
+        header = self.headers.get('X-Request-Timeout')
+        if header:
+            timeout = float(header)
+            if not (math.isfinite(timeout) and timeout > 0):
+                raise ValueError(header)
+            return timeout
+        return getattr(self.server, 'request_timeout', DEFAULT_REQUEST_TIMEOUT)
+
+    def remaining_time(self):
+        return max(self.deadline - time.monotonic(), 0)
+
+    async def run_until_deadline(self, handler):
+        """
+        Runs a request handler coroutine until it finishes, the deadline passes or the client disconnects.
+
+        In the last two cases the handler is cancelled together with its Jira requests, and the error
+        with the progress made so far is sent to the client (if it is still connected).
+        """
+        task = asyncio.ensure_future(handler)
+        disconnect = asyncio.ensure_future(self.wait_for_disconnect())
+        done, _ = await asyncio.wait({task, disconnect}, timeout=self.remaining_time(), return_when=asyncio.FIRST_COMPLETED)
+        disconnect.cancel()
+        if task in done:
+            await task
+            return
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        if disconnect in done:
+            logging.error(f"Client disconnected, {self.path} request cancelled: {self.progress}")
+            self.close_connection = True
+            return
+
+        error = f"The request was not finished in {self.request_timeout:g}s and has been cancelled"
+        logging.error(f"{error}: {self.progress}")
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(json.dumps({'error': error, **self.progress}).encode('utf-8'))
+
+    async def wait_for_disconnect(self):
+        # The request body has been read already, so a readable socket with no data means the client has gone
+        while True:
+            await asyncio.sleep(0.2)
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            if readable:
+                try:
+                    if not self.connection.recv(1, socket.MSG_PEEK):
+                        return
+                except OSError:
+                    return
+
     async def handle_query_issues(self, data):
         try:
             jql = data.get('jql', '')
@@ -290,33 +768,58 @@ class RequestHandler(BaseHTTPRequestHandler):
             response = await self.call_external_api(jira_url)
             jira_summaries = {issue['key']: issue['fields']['summary'] for issue in response.get('issues', [])}
 
+            write_behind = getattr(self.server, 'write_behind', None)
+            if write_behind:
+                # Queued updates are not in Jira yet, so compare with them rather than with the Jira summaries
+                jira_summaries.update(write_behind.queued_summaries())
+
             keys_to_update = [key for key, summary in input_summaries.items() if
                               key not in jira_summaries or jira_summaries[key] != summary]
 
-            for key in keys_to_update:
-                await self.update_jira_summary(key, input_summaries[key])
-
-            logging.info(f"Updated keys: {keys_to_update}")
+            if write_behind:
+                batch_id = write_behind.enqueue({key: input_summaries[key] for key in keys_to_update})
+                result = {'queued_keys': keys_to_update, 'batch_id': batch_id}
+                logging.info(f"Queued keys: {keys_to_update}")
+            else:
+                self.progress = {'updated_keys': [], 'not_updated_keys': list(keys_to_update)}
+                for key in keys_to_update:
+                    await self.update_jira_summary(key, input_summaries[key])
+                    self.progress['updated_keys'].append(key)
+                    self.progress['not_updated_keys'].remove(key)
+                result = {'updated_keys': keys_to_update}
+                logging.info(f"Updated keys: {keys_to_update}")
 
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
             self.end_headers()
-            self.wfile.write(json.dumps({'updated_keys': keys_to_update}).encode('utf-8'))
+            self.wfile.write(json.dumps(result).encode('utf-8'))
         except Exception as e:
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
             self.end_headers()
-            self.wfile.write(json.dumps({'error': str(e)}).encode('utf-8'))
+            self.wfile.write(json.dumps({'error': str(e), **self.progress}).encode('utf-8'))
             logging.error(f"{str(e)}")
             return
 
+    def handle_update_status(self, data):
+        try:
+            write_behind = getattr(self.server, 'write_behind', None)
+            if not write_behind:
+                raise Exception('The driver is not running in the write-behind mode')
+            result = write_behind.status(data.get('batch_id'))
+        except Exception as e:
+            result = {'error': str(e)}
+            logging.error(f"{str(e)}")
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(json.dumps(result).encode('utf-8'))
+
     def get_headers(self):
-        return {
-            'Authorization': f'Bearer {self.server.token}' if self.server.token else ('Basic ' + b64encode(f"{self.server.user}:{self.server.password}".encode()).decode()),
-            'Content-Type': 'application/json'
-        }
+        return jira_headers(self.server)
 
     async def update_jira_summary(self, key, summary):
         jira_url = f'{self.server.jira_server}/rest/api/2/issue/{key}'
@@ -326,29 +829,28 @@ class RequestHandler(BaseHTTPRequestHandler):
             }
         }
         headers = self.get_headers()
-        async with aiohttp.ClientSession() as session:
-            async with session.put(jira_url, json=data, headers=headers) as resp:
-                if resp.status != 204:
-                    logging.error(f"Failed to update summary for {key}: {resp.status}")
+        status, _ = await self.get_transport().request('PUT', jira_url, headers, data, self.remaining_time())
+        if status != 204:
+            logging.error(f"Failed to update summary for {key}: {status}")
+
+    def get_transport(self):
+        return getattr(self.server, 'transport', None) or JiraTransport()
 
     async def call_external_api(self, url, data=None):
         headers = self.get_headers()
-        async with aiohttp.ClientSession() as session:
-            if data:
-                async with session.post(url, json=data, headers=headers) as resp:
-                    if resp.status != 200:
-                        raise Exception("Jira POST failed")
-                    response = await resp.json()
-                    logging.info(
-                        f"Called external API with POST to {url} with data: {data}, received response: {response}")
-                    return response
-            else:
-                async with session.get(url, headers=headers) as resp:
-                    if resp.status != 200:
-                        raise Exception(f"Jira GET failed: {self.server.user}, {self.server.password}  url={url}\nstatus={resp.status}\nheaders={headers}\nbody={await resp.read()}")
-                    response = await resp.json()
-                    logging.info(f"Called external API with GET to {url}, received response: {response}")
-                    return response
+        if data:
+            status, response = await self.get_transport().request('POST', url, headers, data, self.remaining_time())
+            if status != 200:
+                raise Exception("Jira POST failed")
+            logging.info(
+                f"Called external API with POST to {url} with data: {data}, received response: {response}")
+            return response
+        else:
+            status, response = await self.get_transport().request('GET', url, headers, timeout=self.remaining_time())
+            if status != 200:
+                raise Exception(f"Jira GET failed: {self.server.user}, {self.server.password}  url={url}\nstatus={status}\nheaders={headers}\nbody={response}")
+            logging.info(f"Called external API with GET to {url}, received response: {response}")
+            return response
 
 
     def process_jira_response(self, response, resource_groups):
@@ -373,7 +875,8 @@ class RequestHandler(BaseHTTPRequestHandler):
 
 
 
-def run(jira_server, port, token, user, password):
+def run(jira_server, port, token, user, password, transport=None, journal=None, concurrency=4,
+        request_timeout=DEFAULT_REQUEST_TIMEOUT):
     # We accept only local connections to avoid creating a serious vulnerability.
     # Of course, a local malicious app still may access you Jira through the interface,
     # but that is still much better than opening access to remote hosts. :-)
@@ -383,6 +886,12 @@ def run(jira_server, port, token, user, password):
     httpd.user = user
     httpd.password = password
     httpd.jira_server = jira_server
+    httpd.transport = transport or JiraTransport()
+    httpd.request_timeout = request_timeout
+    httpd.write_behind = None
+    if journal:
+        httpd.write_behind = WriteBehindQueue(httpd, journal, concurrency)
+        httpd.write_behind.start()
     logging.info(f'Starting httpd server on port {port}')
     httpd.serve_forever()
 
@@ -394,14 +903,39 @@ if __name__ == '__main__':
     parser.add_argument('--token', type=str, help='Jira API personal access token to use API (the recommended wat of authentication)')
     parser.add_argument('--user', type=str, help='Username for basic Jira API auth (kept for old Jira versions)')
     parser.add_argument('--password', type=str, help='Password for basic Jira API auth (kept for old Jira versions)')
-    parser.add_argument('--jira', type=str, required=True, help='Jira server URL')
+    parser.add_argument('--jira', type=str, help='Jira server URL (required unless --replay is specified)')
+    parser.add_argument('--record', type=str, metavar='CASSETTE', help='Record Jira exchanges (without credentials) to a gzipped cassette file for offline runs')
+    parser.add_argument('--replay', type=str, metavar='CASSETTE', help='Serve Jira exchanges from a recorded cassette file instead of the Jira server')
+    parser.add_argument('--replay-speed', type=float, default=1.0, help='Replay speed relative to the recorded timings, 0 means no delays (default: 1)')
+    parser.add_argument('--write-behind', type=str, metavar='JOURNAL', help='Return from TO JIRA immediately and send the updates in background, keeping them in the journal file until they are sent')
+    parser.add_argument('--write-behind-concurrency', type=int, default=4, help='Maximum number of parallel Jira updates in the write-behind mode (default: 4)')
+    parser.add_argument('--request-timeout', type=float, default=DEFAULT_REQUEST_TIMEOUT, help=f'Seconds after which a request and its Jira calls are cancelled unless the X-Request-Timeout header says otherwise (default: {DEFAULT_REQUEST_TIMEOUT})')
     args = parser.parse_args()
-    if args.token:
-        if args.user or args.password:
-            print("You don't need --user and --password if you specify --token", file=sys.stderr)
-            exit(1)
+    if args.record and args.replay:
+        print("--record and --replay cannot be used together", file=sys.stderr)
+        exit(1)
+    if args.replay_speed < 0:
+        print("--replay-speed cannot be negative", file=sys.stderr)
+        exit(1)
+    if not (math.isfinite(args.request_timeout) and args.request_timeout > 0):
+        print("--request-timeout must be a positive number of seconds", file=sys.stderr)
+        exit(1)
+    if args.replay:
+        # Replayed exchanges do not depend on the Jira host or credentials
+        transport = ReplayTransport(args.replay, args.replay_speed)
+        args.jira = args.jira or 'http://jira.invalid'
     else:
-        if not (args.user and args.password):
-            print("You need to specify --user and --password if you do not specify --token", file=sys.stderr)
+        if not args.jira:
+            print("You need to specify --jira", file=sys.stderr)
+            exit(1)
+        if args.token:
+            if args.user or args.password:
+                print("You don't need --user and --password if you specify --token", file=sys.stderr)
+                exit(1)
+        else:
+            if not (args.user and args.password):
+                print("You need to specify --user and --password if you do not specify --token", file=sys.stderr)
+        transport = RecordingTransport(JiraTransport(), args.record) if args.record else JiraTransport()
 
-    run(jira_server=args.jira, port=args.port, token=args.token, user=args.user, password=args.password)
+    run(jira_server=args.jira, port=args.port, token=args.token, user=args.user, password=args.password, transport=transport,
+        journal=args.write_behind, concurrency=args.write_behind_concurrency, request_timeout=args.request_timeout)